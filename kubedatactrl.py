@@ -1,19 +1,67 @@
 import logging
 import os
-import traceback
-import pykka
-import ConfigParser
+import time
+import configparser
+import queue
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import asdict, dataclass
 
-from kubernetes import client, config, watch
+
+import orjson
+from kubernetes import client, config
+from kubernetes.client.rest import ApiException
 from neoclient import Neo4jClient
 
-conf = ConfigParser.ConfigParser()
-logging.basicConfig(filename='debug.log', level=logging.DEBUG, format='%(asctime)s %(levelname)s: %(message)s')
+conf = configparser.ConfigParser()
+logging.basicConfig(filename='debug.log', level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
 LOG = logging.getLogger(__name__)
 
 
-class KubeDataController(object):
+@dataclass(slots=True)
+class NodeRow:
+    name: str
+    kind: str
+    creation_time: str
+
+
+@dataclass(slots=True)
+class NamespaceRow:
+    name: str
+    kind: str
+    creation_time: str
+    status: str | None
+
+
+@dataclass(slots=True)
+class PodRow:
+    name: str
+    kind: str
+    creation_time: str
+    status: str | None
+    pod_ip: str | None
+    labels: list | None
+    namespace: str
+    node_name: str | None
+    # names of deployments whose selector matches labels, filled in by writer
+    deployments: list | None = None
+
+
+@dataclass(slots=True)
+class DeploymentRow:
+    name: str
+    kind: str
+    creation_time: str
+    replicas: int | None
+    ready_replicas: int
+    labels: list | None
+    namespace: str
+    selector: list | None
+    # set by writer when deployment is new or its selector changed
+    link_pods: bool = False
+
+
+class KubeDataController:
     def __init__(self):
         """
         loads authentication and cluster information and init API
@@ -25,26 +73,37 @@ class KubeDataController(object):
         else:
             config.load_kube_config()
         self.v1api = client.CoreV1Api()
-        self.v1ext = client.ExtensionsV1beta1Api()
-        self.conf = ConfigParser.ConfigParser()
+        self.apps = client.AppsV1Api()
+        self.conf = configparser.ConfigParser()
         conf.read('config.ini')
         self.neoclient = Neo4jClient(conf.get('neo4j', 'connect_url'), conf.get('neo4j', 'user'),
                                      conf.get('neo4j', 'password'))
-
+        # buffered watch events are written to neo4j after _flush_interval seconds
+        # or once _max_batch events are pending, whichever comes first
+        self._flush_interval = 0.5
+        self._max_batch = 500
+        # watch requests are re-issued from the last seen resource version after this many seconds
+        self._watch_timeout = 600
+        self._watch_retry_interval = 5
+        self._write_retry_interval = 5
+        # watchers put (kind, event type, key, row) here and block when writer falls behind,
+        # key is name for cluster scoped objects and (namespace, name) for namespaced ones
+        self.write_queue = queue.Queue(maxsize=10000)
+        # deployment (namespace, name) -> selector, only used by writer thread
+        self._deployments = {}
 
     def watch_node(self):
         """
         watch node event and create record to neo4j database
         :return:
         """
-        w = watch.Watch()
-        for event in w.stream(self.v1api.list_node):
+        for event in self._watch(self.v1api.list_node):
             evt_type = event['type']
             if 'ADDED' == evt_type:
                 # extract properties from Event
-                props = self._build_base_props(event)
-                # create or update Node to neo4j database
-                self.neoclient.create_node(props)
+                obj = event['object']
+                row = NodeRow(obj['metadata']['name'], obj['kind'], self._creation_time(obj))
+                self.write_queue.put(('node', evt_type, row.name, row))
             else:
                 # skip Node update/delete action for now
                 pass
@@ -54,15 +113,14 @@ class KubeDataController(object):
         watch namespaces and create to neo4j database
         :return:
         """
-        w = watch.Watch()
-        for event in w.stream(self.v1api.list_namespace):
+        for event in self._watch(self.v1api.list_namespace):
             evt_type = event['type']
             if evt_type in ['ADDED', 'MODIFIED']:
                 # extract properties from Event
-                props = self._build_base_props(event)
-                props['status'] = event['object'].status.phase
-                # create or update Node to database
-                self.neoclient.upsert_namespace(props)
+                obj = event['object']
+                row = NamespaceRow(obj['metadata']['name'], obj['kind'], self._creation_time(obj),
+                                   obj['status'].get('phase'))
+                self.write_queue.put(('namespace', evt_type, row.name, row))
             else:
                 # skip namespace delete for now
                 pass
@@ -72,89 +130,218 @@ class KubeDataController(object):
         watch pod create/update/delete event and operate neo4j database record accordingly
         :return:
         """
-        w = watch.Watch()
-        for event in w.stream(self.v1api.list_pod_for_all_namespaces):
-            # get objects which could have relationship with pod
-            labels = event['object'].metadata.labels
-            namespace = event['object'].metadata.namespace
-            node_name = event['object'].spec.node_name
+        for event in self._watch(self.v1api.list_pod_for_all_namespaces):
             evt_type = event['type']
             if evt_type in ['ADDED', 'MODIFIED']:
-                # extract properties from Event
-                props = self._build_base_props(event)
-                props['status'] = event['object'].status.phase
-                props['pod_ip'] = event['object'].status.pod_ip
-                self.neoclient.upsert_pod(props, labels=labels, namespace=namespace, node_name=node_name)
+                # extract properties and objects which could have relationship with pod from Event
+                obj = event['object']
+                metadata = obj['metadata']
+                row = PodRow(metadata['name'], obj['kind'], self._creation_time(obj),
+                             status=obj['status'].get('phase'),
+                             pod_ip=obj['status'].get('podIP'),
+                             labels=self._to_property(metadata.get('labels')),
+                             namespace=metadata['namespace'],
+                             node_name=obj['spec'].get('nodeName'))
+                self.write_queue.put(('pod', evt_type, (row.namespace, row.name), row))
             elif 'DELETED' == evt_type:
-                self.neoclient.remove_pod(event['object'].metadata.name)
+                metadata = event['object']['metadata']
+                self.write_queue.put(('pod', evt_type, (metadata['namespace'], metadata['name']), None))
 
     def watch_deployment(self):
         """
         watch deployment object and CUD db record
         :return:
         """
-        w = watch.Watch()
-        for event in w.stream(self.v1ext.list_deployment_for_all_namespaces):
-            labels = event['object'].metadata.labels
-            namespace = event['object'].metadata.namespace
-            selector = event['object'].spec.selector.match_labels
+        for event in self._watch(self.apps.list_deployment_for_all_namespaces):
             evt_type = event['type']
             if evt_type in ['ADDED', 'MODIFIED']:
                 # extract properties from Event
-                props = self._build_base_props(event)
-                props['replicas'] = event['object'].spec.replicas
-                props['ready_replicas'] = event['object'].status.ready_replicas if event['object'].status.ready_replicas else 0
-                self.neoclient.upsert_deployment(props, labels=labels, namespace=namespace, selector=selector)
+                obj = event['object']
+                metadata = obj['metadata']
+                row = DeploymentRow(metadata['name'], obj['kind'], self._creation_time(obj),
+                                    replicas=obj['spec'].get('replicas'),
+                                    ready_replicas=obj['status'].get('readyReplicas') or 0,
+                                    labels=self._to_property(metadata.get('labels')),
+                                    namespace=metadata['namespace'],
+                                    selector=self._to_property(obj['spec']['selector'].get('matchLabels')))
+                self.write_queue.put(('deployment', evt_type, (row.namespace, row.name), row))
             elif 'DELETED' == evt_type:
-                self.neoclient.remove_deployment(event['object'].metadata.name)
-
-
-    def _build_base_props(self, event):
-        """
-        extract common properties from event object
-        :param event: Watcher stream event
-        :return: dictionary of props
-        """
-        props = {}
-        obj = event['object']
-        props['name'] = obj.metadata.name
-        props['kind'] = obj.kind
-        props['creation_time'] = obj.metadata.creation_timestamp.strftime("%Y-%m-%d %H:%M")
-        return props
-
-
-class EventActor(pykka.ThreadingActor):
-    def __init__(self, controller):
-        super(EventActor, self).__init__()
-        self.controller = controller
-
-    def on_receive(self, message):
-        try:
-            if message.get('type') == 'namespace':
-                self.controller.watch_namespace()
-            elif message.get('type') == 'node':
-                self.controller.watch_node()
-            elif message.get('type') == 'pod':
-                self.controller.watch_pod()
-            elif message.get('type') == 'deployment':
-                self.controller.watch_deployment()
-            else:
-                # skip for now
-                return None
-        except Exception as e:
-            LOG.exception('Error occur when process event %s' % traceback.format_exc())
-            raise Exception('Event error %s' % e.message)
+                metadata = event['object']['metadata']
+                self.write_queue.put(('deployment', evt_type, (metadata['namespace'], metadata['name']), None))
+
+    def _watch(self, list_func):
+        """
+        stream events of list_func forever, resuming from the last seen resource version
+        so a reconnect does not replay objects already written
+        events are parsed from the raw response, event['object'] is the dict sent by API server
+        :param list_func: API list function to watch
+        :return: generator of watch events
+        """
+        resource_version = None
+        while True:
+            kwargs = {'watch': True, 'allow_watch_bookmarks': True, 'timeout_seconds': self._watch_timeout,
+                      '_preload_content': False, '_request_timeout': self._watch_timeout + 30}
+            if resource_version:
+                kwargs['resource_version'] = resource_version
+            try:
+                resp = list_func(**kwargs)
+                try:
+                    for line in self._iter_lines(resp):
+                        event = orjson.loads(line)
+                        evt_type = event['type']
+                        obj = event['object']
+                        if 'ERROR' == evt_type:
+                            raise ApiException(status=obj.get('code'), reason=obj.get('message'))
+                        resource_version = obj['metadata']['resourceVersion']
+                        if 'BOOKMARK' != evt_type:
+                            yield event
+                finally:
+                    resp.close()
+                    resp.release_conn()
+            except ApiException as e:
+                if e.status == 410:
+                    # resource version expired, start over from a full list
+                    LOG.info('resource version %s of %s expired', resource_version, list_func.__name__)
+                    resource_version = None
+                else:
+                    LOG.exception('failed to watch %s', list_func.__name__)
+                    time.sleep(self._watch_retry_interval)
+            except Exception:
+                LOG.exception('failed to watch %s', list_func.__name__)
+                time.sleep(self._watch_retry_interval)
+
+    @staticmethod
+    def _iter_lines(resp):
+        """
+        split streamed watch response into lines, one event per line
+        :param resp: urllib3 response
+        :return: generator of lines as bytes
+        """
+        buffer = b''
+        for chunk in resp.stream(amt=None, decode_content=False):
+            buffer += chunk
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                if line:
+                    yield line
+
+    def writer(self):
+        """
+        single consumer of write_queue, write buffered events to neo4j in batches
+        :return:
+        """
+        rows, deleted = None, None
+        with self.neoclient.session() as session:
+            while True:
+                rows, deleted = self._drain(rows, deleted)
+                deployments = self._match_deployments(rows, deleted)
+                if self.neoclient.write_batch(
+                        {kind: [asdict(row) for row in pending.values()] for kind, pending in rows.items()},
+                        {kind: [{'namespace': namespace, 'name': name} for namespace, name in keys]
+                         for kind, keys in deleted.items()},
+                        session=session):
+                    self._deployments = deployments
+                    rows, deleted = None, None
+                else:
+                    # forget deployments of failed batch so they link pods again when it is retried
+                    for key in set(rows['deployment']) | deleted['deployment']:
+                        self._deployments.pop(key, None)
+                    # keep failed batch, newer events are merged into it before it is written again
+                    time.sleep(self._write_retry_interval)
+
+    def _match_deployments(self, rows, deleted):
+        """
+        find deployments each pod belongs to, using cached selectors updated by this batch.
+        the cache itself is left untouched, writer replaces it once the batch is written
+        :param rows: latest rows by kind and key
+        :param deleted: deleted keys by kind
+        :return: deployment selectors by namespace and name including this batch
+        """
+        deployments = dict(self._deployments)
+        for key in deleted['deployment']:
+            deployments.pop(key, None)
+        for key, row in rows['deployment'].items():
+            selector = frozenset(row.selector or ())
+            # pods written before this deployment was known have to be linked from its side
+            row.link_pods = deployments.get(key) != selector
+            deployments[key] = selector
+        for row in rows['pod'].values():
+            labels = set(row.labels or ())
+            # selector only applies to pods in the namespace of deployment
+            row.deployments = [name for (namespace, name), selector in deployments.items()
+                               if namespace == row.namespace and selector and selector <= labels]
+        return deployments
+
+    def _drain(self, rows=None, deleted=None):
+        """
+        take events from write_queue until _flush_interval seconds passed since the first one
+        or _max_batch events are taken.
+        only the latest state of each object is kept, so bursts of MODIFIED events are written once
+        :param rows: rows of a failed batch to write again, None to start a new batch
+        :param deleted: deleted keys of the failed batch
+        :return: latest rows by kind and key, deleted keys by kind
+        """
+        if rows is None:
+            rows = {'node': {}, 'namespace': {}, 'pod': {}, 'deployment': {}}
+            deleted = {'pod': set(), 'deployment': set()}
+            item = self.write_queue.get()
+        else:
+            # failed batch is written again after the window even if no new event arrives
+            item = None
+        deadline = time.monotonic() + self._flush_interval
+        count = 0
+        while True:
+            if item is not None:
+                count += 1
+                kind, evt_type, key, row = item
+                if 'DELETED' == evt_type:
+                    deleted[kind].add(key)
+                    # drop update buffered before the object was deleted
+                    rows[kind].pop(key, None)
+                else:
+                    rows[kind][key] = row
+            timeout = deadline - time.monotonic()
+            if count >= self._max_batch or timeout <= 0:
+                break
+            try:
+                item = self.write_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+        return rows, deleted
+
+    @staticmethod
+    def _creation_time(obj):
+        """
+        format creation timestamp of object as "YYYY-MM-DD HH:MM"
+        :param obj: kubernetes object dict, creationTimestamp is RFC 3339 like "2018-04-01T10:20:33Z"
+        :return: creation time string
+        """
+        return obj['metadata']['creationTimestamp'][:16].replace('T', ' ')
+
+    @staticmethod
+    def _to_property(mapping):
+        """
+        flatten labels or selector to neo4j property
+        :param mapping: dictionary of labels
+        :return: array of "key=value" or None if empty
+        """
+        if not mapping:
+            return None
+        return [f'{key}={value}' for key, value in mapping.items()]
 
 
 if __name__ == '__main__':
     ctrl = KubeDataController()
+    executor = ThreadPoolExecutor(max_workers=5, thread_name_prefix='kwatch')
+    futures = [executor.submit(getattr(ctrl, f'watch_{kind}')) for kind in ('node', 'namespace', 'pod', 'deployment')]
+    futures.append(executor.submit(ctrl.writer))
     try:
-        for evt in ['node', 'namespace', 'pod', 'deployment']:
-            actor = EventActor(ctrl).start(ctrl)
-            actor.tell({'type': evt})
-
+        # watchers and writer loop forever, a completed future means one of them failed
+        for future in as_completed(futures):
+            future.result()
     except Exception as e:
-        LOG.exception('Exception occur %s' % e.message)
-        # Clean up
-        pykka.ActorRegistry.stop_all()
-
+        LOG.exception('Exception occur %s', e)
+    finally:
+        ctrl.neoclient.close()
+        # remaining threads never return, exit so the process gets restarted
+        os._exit(1)
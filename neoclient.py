@@ -1,246 +1,205 @@
 import logging
-import traceback
-import time
+from contextlib import contextmanager
 
-from neo4j.v1 import GraphDatabase, ServiceUnavailable
+from neo4j import GraphDatabase
 
 LOG = logging.getLogger(__name__)
 
 
 class Neo4jClient:
     def __init__(self, uri, user, password):
-        self._driver = GraphDatabase.driver(uri, auth=(user, password))
+        # all writes go through one writer session, so a small pool is enough; fail fast when
+        # the database is unreachable and test connections idle for a minute before reusing them
+        self._driver = GraphDatabase.driver(uri, auth=(user, password),
+                                            max_connection_pool_size=8,
+                                            connection_acquisition_timeout=30,
+                                            max_connection_lifetime=3600,
+                                            liveness_check_timeout=60,
+                                            keep_alive=True)
+        self._init_schema()
 
     def close(self):
         self._driver.close()
 
-    def create_node(self, props):
+    def _init_schema(self):
         """
-        create node
-        :param props: properties of node like name, creation time
-        :return: True if success or False when exceptions
+        create uniqueness constraints so MERGE is an index seek.
+        nodes and namespaces are cluster scoped and unique by name,
+        pods and deployments are only unique by name within their namespace
+        :return: none
         """
         try:
+            # drop name-only constraints of namespaced labels, they would merge objects of different namespaces
             with self._driver.session() as session:
-                session.write_transaction(lambda tx: tx.run(
-                    "MERGE (:Node {name: $name, kind: $kind, created: $created})",
-                    name=props['name'], kind=props['kind'], created=props['creation_time']))
-            return True
-        except ServiceUnavailable:
-            LOG.exception('failed to create Node to database %s, %s' % (props['name'], traceback.format_exc()))
-            return False
-
-    def upsert_namespace(self, props):
-        """
-        create and update namespace
-        :param props: properties of namespace
-        :return: True if success or False when exceptions
-        """
+                names = [record['name'] for record in session.run(
+                    "SHOW CONSTRAINTS YIELD name, labelsOrTypes, properties "
+                    "WHERE labelsOrTypes IN [['Pod'], ['Deployment']] AND properties = ['name'] "
+                    "RETURN name")]
+                for name in names:
+                    session.run(f"DROP CONSTRAINT `{name}` IF EXISTS").consume()
+        except Exception:
+            LOG.exception('failed to drop name constraints of Pod and Deployment')
+        for label, key in [('Node', 'n.name'), ('Namespace', 'n.name'),
+                           ('Pod', '(n.namespace, n.name)'), ('Deployment', '(n.namespace, n.name)')]:
+            try:
+                with self._driver.session() as session:
+                    session.run(f"CREATE CONSTRAINT IF NOT EXISTS FOR (n:{label}) REQUIRE {key} IS UNIQUE").consume()
+            except Exception:
+                LOG.exception('failed to create constraint on %s', label)
         try:
+            # deployments link existing pods of their namespace
             with self._driver.session() as session:
-                session.write_transaction(lambda tx: tx.run(
-                    "MERGE (:Namespace {name: $name, kind: $kind, created: $created})",
-                    name=props['name'], kind=props['kind'], created=props['creation_time']))
-                if props['status']:
-                    session.write_transaction(lambda tx: tx.run(
-                        "MATCH (n:Namespace {name: $name}) "
-                        "SET n.status = $status", name=props['name'], status=props['status']))
-            return True
-        except ServiceUnavailable:
-            LOG.exception(
-                'failed to create/update Namespace to database %s, %s' % (props['name'], traceback.format_exc()))
-            return False
+                session.run("CREATE INDEX IF NOT EXISTS FOR (p:Pod) ON (p.namespace)").consume()
+        except Exception:
+            LOG.exception('failed to create index on Pod namespace')
 
-    def upsert_pod(self, props, **kwargs):
+    def session(self):
         """
-        create or update pod
-        :param args: properties include name, pod_ip, status
-                     **kwargs are relationships of pod
-                     Pod -- runsOn --> Node
-                     Pod -- associateTo --> Namespace
-        :return:
+        open a session which callers can reuse for many writes
+        :return: neo4j session, use it as context manager
         """
-        try:
-            with self._driver.session() as session:
-                # create pod
-                session.write_transaction(lambda tx: tx.run(
-                    "MERGE (:Pod {name: $name, kind: $kind, created: $created})",
-                    name=props['name'], kind=props['kind'], created=props['creation_time']))
-
-                # update pod IP, status after finish scheduling
-                if props['pod_ip'] and props['status']:
-                    session.write_transaction(lambda tx: tx.run(
-                        "MATCH (p:Pod {name: $name}) "
-                        "SET p.status = $status, p.pod_ip=$pod_ip", name=props['name'], pod_ip=props['pod_ip'],
-                        status=props['status']))
+        return self._driver.session()
 
-                labels = kwargs.get('labels')
-                if labels:
-                    label_property = []
-                    for key, value in labels.items():
-                        label_property.append('%s=%s' % (key, value))
-                    session.write_transaction(self.update_pod_label, props['pod_ip'], label_property)
-
-                    # link to deployment if pod created by deployment
-                    deploys = session.read_transaction(self.get_deployments)
-                    if deploys:
-                        for dp in deploys:
-                            selector = dp['selector']
-                            if selector:
-                                condition = 'WHERE '
-                                for i in range(len(selector)):
-                                    condition += '"%s" in p.labels ' % selector[i]
-                                    if i < len(selector) - 1:
-                                        condition += "AND "
-                                session.write_transaction(lambda tx: tx.run(
-                                    "MATCH (d:Deployment {name: $name}) "
-                                    "MATCH (p:Pod) %s"
-                                    "MERGE (d)-[:scheduledTo]->(p)" % condition, name=dp['name']
-                                ))
-
-                node_name = kwargs.get('node_name')
-                if node_name:
-                    # link pod with node
-                    session.write_transaction(self.add_pod_to_node, props['pod_ip'], node_name)
-                namespace = kwargs.get('namespace')
-                if namespace:
-                    # link pod with namespace
-                    session.write_transaction(self.add_pod_to_namespace, props['pod_ip'], namespace)
-            return True
-        except Exception:
-            LOG.exception('failed to create/update Pod %s, %s' % (props['name'], traceback.format_exc()))
-            return False
-
-    def remove_pod(self, pod_name):
+    @contextmanager
+    def _session(self, session):
         """
-        remove pod from database if got delete event
-        :param pod_name: pod unique name
-        :return:
+        reuse session of caller or open a short lived one
+        :param session: session opened by caller or None
+        :return: neo4j session
         """
-        try:
+        if session is not None:
+            yield session
+        else:
             with self._driver.session() as session:
-                session.write_transaction(lambda tx: tx.run(
-                    "MATCH (p:Pod {name: $name}) "
-                    "DETACH DELETE p", name=pod_name
-                ))
-            return True
-        except Exception:
-            LOG.exception('failed to remove Pod %s, %s' % (pod_name, traceback.format_exc()))
-            return False
-
-    def upsert_deployment(self, props, **kwargs):
-        """
-        create or update deployment
-        :param args: properties include name, replica, ready_replicas
-                     **kwargs are relationships
-                     Deployment -- scheduleTo --> Pod
-                     Deployment -- associateTo --> Namespace
-        :return:
+                yield session
+
+    def write_batch(self, rows, deleted, session=None):
+        """
+        write one batch of buffered events in a single managed transaction with one commit,
+        statements of all kinds run one after another inside it
+        :param rows: properties by kind, keys are node, namespace, deployment and pod
+                     Pod -- runsOn --> Node (node_name)
+                     Pod -- associateTo --> Namespace (namespace)
+                     Deployment -- associateTo --> Namespace (namespace)
+                     Deployment -- scheduledTo --> Pod (selector)
+        :param deleted: namespace and name of objects got delete event by kind, keys are deployment and pod
+        :param session: session to reuse, a new one is opened if None
+        :return: True if success or False when exceptions
         """
         try:
-            with self._driver.session() as session:
-                # create deployment
-                session.write_transaction(lambda tx: tx.run(
-                    "MERGE (:Deployment {name: $name, kind: $kind, created: $created})",
-                    name=props['name'], kind=props['kind'], created=props['creation_time']))
-
-                if props['ready_replicas'] and props['replicas']:
-                    session.write_transaction(lambda tx: tx.run(
-                        "MATCH (d:Deployment {name: $name}) "
-                        "SET d.replicas = $replicas, d.ready_replicas = $ready_replicas", name=props['name'],
-                        replicas=props['replicas'], ready_replicas=props['ready_replicas']
-                    ))
-                labels = kwargs.get('labels')
-                if labels:
-                    label_property = []
-                    for key, value in labels.items():
-                        label_property.append('%s=%s' % (key, value))
-                    session.write_transaction(lambda tx: tx.run(
-                        "MATCH (d:Deployment {name: $name}) "
-                        "SET d.labels = $labels", name=props['name'], labels=label_property
-                    ))
-                namespace = kwargs.get('namespace')
-                if namespace:
-                    # link deploy with namespace
-                    session.write_transaction(lambda tx: tx.run(
-                        "MATCH (d:Deployment {name: $name}) "
-                        "MATCH (n:Namespace {name: $namespace}) "
-                        "MERGE (d)-[:associateTo]->(n)", name=props['name'], namespace=namespace
-                    ))
-                selector = kwargs.get('selector')
-                if selector:
-                    selector_property = []
-                    for key, value in selector.items():
-                        selector_property.append('%s=%s' % (key, value))
-                    session.write_transaction(lambda tx: tx.run(
-                        "MATCH (d:Deployment {name: $name}) "
-                        "SET d.selector = $selector", name=props['name'], selector=selector_property
-                    ))
-
+            with self._session(session) as session:
+                session.execute_write(self.merge_batch, rows, deleted)
             return True
         except Exception:
-            LOG.exception('failed to create/update Deployment %s, %s' % (props['name'], traceback.format_exc()))
+            count = sum(len(kind_rows) for kind_rows in rows.values())
+            LOG.exception('failed to write %d objects to database', count)
             return False
 
-
-    def remove_deployment(self, name):
+    @staticmethod
+    def merge_batch(tx, rows, deleted):
         """
-        remove deployment from database if got delete event
-        :param name: deployment name
-        :return:
+        run the statements of all kinds in one transaction
+        :param tx:
+        :param rows: properties by kind
+        :param deleted: names by kind
+        :return: none
         """
-        try:
-            with self._driver.session() as session:
-                session.write_transaction(lambda tx: tx.run(
-                    "MATCH (d:Deployment {name: $name}) "
-                    "DETACH DELETE d", name=name
-                ))
-            return True
-        except Exception:
-            LOG.exception('failed to remove deployment %s, %s' % (name, traceback.format_exc()))
-            return False
+        # nodes and namespaces first so pods and deployments can link to them
+        if rows['node']:
+            Neo4jClient.merge_nodes(tx, rows['node'])
+        if rows['namespace']:
+            Neo4jClient.merge_namespaces(tx, rows['namespace'])
+        Neo4jClient.merge_deployments(tx, rows['deployment'], deleted['deployment'])
+        Neo4jClient.merge_pods(tx, rows['pod'], deleted['pod'])
 
     @staticmethod
-    def get_deployments(tx):
-        return list(tx.run("MATCH (d:Deployment) return d.name as name, d.selector as selector"))
+    def merge_nodes(tx, rows):
+        """
+        create nodes if not exist
+        :param tx:
+        :param rows: array of node properties
+        :return: none
+        """
+        tx.run("UNWIND $rows AS r "
+               "MERGE (n:Node {name: r.name}) "
+               "ON CREATE SET n.kind = r.kind, n.created = r.creation_time",
+               rows=rows)
 
     @staticmethod
-    def update_pod_label(tx, pod_ip, labels):
+    def merge_namespaces(tx, rows):
         """
-        update pod label
+        create namespaces if not exist and update status
         :param tx:
-        :param pod_ip: pod uniq ip
-        :param labels array of label
+        :param rows: array of namespace properties
         :return: none
         """
-        tx.run("MATCH (p:Pod {pod_ip: $pod_ip}) "
-               "SET p.labels = $labels",
-               pod_ip=pod_ip, labels=labels)
+        tx.run("UNWIND $rows AS r "
+               "MERGE (n:Namespace {name: r.name}) "
+               "ON CREATE SET n.kind = r.kind, n.created = r.creation_time "
+               "SET n.status = r.status",
+               rows=rows)
 
     @staticmethod
-    def add_pod_to_node(tx, pod_ip, node_name):
+    def merge_pods(tx, rows, deleted):
         """
-        create pod -> node relationship if not exist
+        remove deleted pods, then create or update pods and link them with node, namespace and deployment
         :param tx:
-        :param pod_ip: pod uniq ip
-        :param node_name:
+        :param rows: array of pod properties, deployments are names of deployments whose selector matches
+        :param deleted: array of pod namespace and name
         :return: none
         """
-        tx.run("MATCH (p:Pod {pod_ip: $pod_ip}) "
-               "MATCH (n:Node {name: $node_name}) "
-               "MERGE (p)-[:runsOn]->(n)",
-               pod_ip=pod_ip, node_name=node_name)
+        if deleted:
+            tx.run("UNWIND $deleted AS k "
+                   "MATCH (p:Pod {namespace: k.namespace, name: k.name}) "
+                   "DETACH DELETE p",
+                   deleted=deleted)
+        if not rows:
+            return
+        # create pod and link it with node, namespace and deployment if they exist
+        tx.run("UNWIND $rows AS r "
+               "MERGE (p:Pod {namespace: r.namespace, name: r.name}) "
+               "ON CREATE SET p.kind = r.kind, p.created = r.creation_time "
+               "SET p.status = r.status, p.pod_ip = r.pod_ip, p.labels = r.labels "
+               "WITH p, r "
+               "OPTIONAL MATCH (n:Node {name: r.node_name}) "
+               "FOREACH (_ IN CASE WHEN n IS NULL THEN [] ELSE [1] END | MERGE (p)-[:runsOn]->(n)) "
+               "WITH p, r "
+               "OPTIONAL MATCH (ns:Namespace {name: r.namespace}) "
+               "FOREACH (_ IN CASE WHEN ns IS NULL THEN [] ELSE [1] END | MERGE (p)-[:associateTo]->(ns)) "
+               "WITH p, r "
+               "UNWIND r.deployments AS deployment "
+               "MATCH (d:Deployment {namespace: r.namespace, name: deployment}) "
+               "MERGE (d)-[:scheduledTo]->(p)",
+               rows=rows)
 
     @staticmethod
-    def add_pod_to_namespace(tx, pod_ip, namespace):
+    def merge_deployments(tx, rows, deleted):
         """
-        create pod -> namespace relationship if missing
+        remove deleted deployments, then create or update deployments and link them with namespace.
+        existing pods of same namespace matching the selector are linked too when link_pods is set
         :param tx:
-        :param pod_ip:
-        :param namespace:
-        :return:
-        """
-        tx.run("MATCH (p:Pod {pod_ip: $pod_ip}) "
-               "MATCH (n:Namespace {name: $namespace}) "
-               "MERGE (p)-[:associateTo]->(n)",
-               pod_ip=pod_ip, namespace=namespace)
\ No newline at end of file
+        :param rows: array of deployment properties
+        :param deleted: array of deployment namespace and name
+        :return: none
+        """
+        if deleted:
+            tx.run("UNWIND $deleted AS k "
+                   "MATCH (d:Deployment {namespace: k.namespace, name: k.name}) "
+                   "DETACH DELETE d",
+                   deleted=deleted)
+        if not rows:
+            return
+        tx.run("UNWIND $rows AS r "
+               "MERGE (d:Deployment {namespace: r.namespace, name: r.name}) "
+               "ON CREATE SET d.kind = r.kind, d.created = r.creation_time "
+               "SET d.replicas = r.replicas, d.ready_replicas = r.ready_replicas, "
+               "d.labels = r.labels, d.selector = r.selector "
+               "WITH d, r "
+               "OPTIONAL MATCH (ns:Namespace {name: r.namespace}) "
+               "FOREACH (_ IN CASE WHEN ns IS NULL THEN [] ELSE [1] END | MERGE (d)-[:associateTo]->(ns)) "
+               "WITH d, r "
+               "WHERE r.link_pods AND size(r.selector) > 0 "
+               "MATCH (p:Pod {namespace: r.namespace}) "
+               "WHERE ALL(s IN r.selector WHERE s IN p.labels) "
+               "MERGE (d)-[:scheduledTo]->(p)",
+               rows=rows)